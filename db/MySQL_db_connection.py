@@ -6,18 +6,17 @@ from dotenv import load_dotenv
 load_dotenv()
 
 _POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "5"))          
-_POOL_GET_TIMEOUT = float(os.getenv("MYSQL_POOL_TIMEOUT", "10"))  
 _POOL_PING = os.getenv("MYSQL_POOL_PING", "true").lower() == "true" 
 
 _pools = {}            
 _pools_lock = Lock()   
 
 
-def _make_key(host: str, user: str, db: str) -> tuple[str, str, str]:
-    return (host, user, db)
+def _make_key(host: str, user: str, db: str, local_infile: bool = False) -> tuple[str, str, str, bool]:
+    return (host, user, db, local_infile)
 
 
-def _create_connection(host: str, user: str, pwd: str, db: str) -> pymysql.connections.Connection:
+def _create_connection(host: str, user: str, pwd: str, db: str, local_infile: bool = False) -> pymysql.connections.Connection:
     return pymysql.connect(
         host=host,
         user=user,
@@ -26,11 +25,13 @@ def _create_connection(host: str, user: str, pwd: str, db: str) -> pymysql.conne
         charset="utf8mb4",
         cursorclass=pymysql.cursors.DictCursor,
         autocommit=False, 
+        # 開了之後 server 要哪個檔 client 就送哪個，只給明確要 LOAD DATA LOCAL 的呼叫者用
+        local_infile=local_infile,
     )
 
 
-def _get_pool(host: str, user: str, db: str) -> Queue:
-    key = _make_key(host, user, db)
+def _get_pool(host: str, user: str, db: str, local_infile: bool = False) -> Queue:
+    key = _make_key(host, user, db, local_infile)
     with _pools_lock:
         if key not in _pools:
             _pools[key] = Queue(maxsize=_POOL_SIZE)
@@ -38,17 +39,19 @@ def _get_pool(host: str, user: str, db: str) -> Queue:
 
 
 class MySQLConn:
-    def __init__(self, db: str):
+    def __init__(self, db: str, local_infile: bool = False):
         self.host = os.getenv("MYSQL_DB_HOST")
         self.user = os.getenv("MYSQL_DB_USER")
         self.password = os.getenv("MYSQL_DB_PWD")
         self.db = db
-        self._pool = _get_pool(self.host, self.user, self.db)
+        self.local_infile = local_infile
+        self._pool = _get_pool(self.host, self.user, self.db, self.local_infile)
         self.conn = None
 
     def __enter__(self):
         try:
-            conn = self._pool.get(timeout=_POOL_GET_TIMEOUT)
+            # 池子只存閒置連線、不限總數；空的就直接新建，不要卡在 get() 等待
+            conn = self._pool.get_nowait()
             if _POOL_PING:
                 try:
                     conn.ping(reconnect=True)
@@ -62,7 +65,7 @@ class MySQLConn:
             conn = None
 
         if conn is None:
-            conn = _create_connection(self.host, self.user, self.password, self.db)
+            conn = _create_connection(self.host, self.user, self.password, self.db, self.local_infile)
 
         self.conn = conn
         return self.conn
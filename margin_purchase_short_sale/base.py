@@ -2,6 +2,7 @@ import os
 import requests
 import pandas as pd
 from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -47,38 +48,39 @@ SNAKE_EXPECTED = [
     "short_sale_yesterday_balance",
 ]
 
-def fetch_margin_short(stock_id: str, start_date: str, end_date: str) -> pd.DataFrame:
+# 已知的 FinMind 欄位；出現其他欄位代表 schema 有變動
+FINMIND_KNOWN_KEYS = frozenset(["date", "stock_id", *FINMIND_TO_SNAKE])
+# 依 SNAKE_EXPECTED 順序排好的 FinMind 原始欄位名（date、stock_id 之後）
+_FINMIND_FIELDS = [{v: k for k, v in FINMIND_TO_SNAKE.items()}[c] for c in SNAKE_EXPECTED[2:]]
+
+def fetch_margin_short_records(
+    stock_id: str, start_date: str, end_date: str, session: Optional[requests.Session] = None
+) -> List[Dict[str, Any]]:
+    """回傳 FinMind 原始 data（list of dict），不經 pandas。"""
     params = {
         "dataset": "TaiwanStockMarginPurchaseShortSale",
         "data_id": stock_id,
         "start_date": start_date,
         "end_date": end_date,
     }
-    resp = requests.get(URL, headers=HEADERS, params=params, timeout=30)
+    http = session or requests  # 傳入 Session 可重用 keep-alive 連線
+    resp = http.get(URL, headers=HEADERS, params=params, timeout=30)
     resp.raise_for_status()
     res = resp.json()
-    if "data" not in res or not res["data"]:
-        return pd.DataFrame()
-    return pd.DataFrame(res["data"])
+    return res.get("data") or []
+
+def row_to_tuple(d: Dict[str, Any]) -> Tuple:
+    """單筆 FinMind dict → 依 SNAKE_EXPECTED 順序的 tuple（缺欄為 None）。"""
+    return ((d.get("date") or "")[:10] or None, d.get("stock_id"), *(d.get(k) for k in _FINMIND_FIELDS))
 
 def finmind_to_snake(df: pd.DataFrame) -> pd.DataFrame:
-    """將 FinMind 欄位轉成你 DB 使用的 snake_case，補齊缺欄、格式化日期。"""
+    """將 FinMind 欄位轉成你 DB 使用的 snake_case，補齊缺欄、日期轉 datetime64。"""
     if df.empty:
         return df.copy()
-    df = df.copy()
-    df.rename(columns=FINMIND_TO_SNAKE, inplace=True)
-    for col in SNAKE_EXPECTED:
-        if col not in df.columns:
-            df[col] = pd.NA
-    if "date" in df.columns:
-        df["date"] = pd.to_datetime(df["date"], errors="coerce").dt.date.astype("string")
+    # rename 本身就回傳新物件；reindex 一次補齊缺欄並排好欄位順序（未知欄位放最後）
+    df = df.rename(columns=FINMIND_TO_SNAKE)
     remain = [c for c in df.columns if c not in SNAKE_EXPECTED]
-    # 僅保留資料庫需要的欄位，不再加入 _fetched_at 與 _source
-    out = df[SNAKE_EXPECTED + remain].sort_values("date", kind="stable")
-    return out
-
-def df_nulls_to_none(df: pd.DataFrame) -> pd.DataFrame:
-    """把 NaN/pd.NA 轉 None，方便 PyMySQL 寫入。"""
-    if df.empty:
-        return df
-    return df.where(pd.notnull(df), None)
\ No newline at end of file
+    df = df.reindex(columns=SNAKE_EXPECTED + remain, fill_value=pd.NA)
+    # 保持 datetime64，不再繞 .dt.date → string 的 object 轉換；PyMySQL 可直接寫入 DATE
+    df["date"] = pd.to_datetime(df["date"], errors="coerce")
+    return df.sort_values("date", kind="stable")
@@ -1,10 +1,22 @@
 from __future__ import annotations
 from datetime import date, datetime, timedelta
-from typing import Iterable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+import os
+import queue
+import tempfile
+import threading
 import time
 import pandas as pd
+import pymysql
+import requests
 
-from margin_purchase_short_sale.base import fetch_margin_short, finmind_to_snake, df_nulls_to_none
+from margin_purchase_short_sale.base import (
+    FINMIND_KNOWN_KEYS,
+    fetch_margin_short_records,
+    finmind_to_snake,
+    row_to_tuple,
+)
 from margin_purchase_short_sale.ticker import tickers
 from db.MySQL_db_connection import MySQLConn  # 你的連線池模組
 
@@ -13,8 +25,18 @@ DB_NAME = "stock_market_data_lake"
 TABLE = "taiwan_stock_margin_purchase_short_sale"
 
 START_FALLBACK = "2001-01-01"   # DB 無資料時的起點
-CHUNK_DAYS = 4500                # 分段抓的天數
-SLEEP_BETWEEN_CALLS = 0.1       # 每段間隔，避免打太兇
+CHUNK_DAYS = 4500                # 單次請求被拒時改分段抓的天數
+SLEEP_BETWEEN_CALLS = 0.1       # 只在重試/分段時等待，避免打太兇
+FALLBACK_STATUS = (413, 429)    # 這些 4xx 退回分段抓（5xx、逾時、連線錯誤也會）；其餘 4xx 直接放棄
+
+FETCH_WORKERS = 8               # 並行抓 FinMind 的執行緒數
+FINMIND_CONCURRENCY = 4         # 同時打 FinMind 的請求上限（依方案 TPS 調整）
+WRITE_QUEUE_SIZE = 32           # 待寫入區間的佇列上限
+FLUSH_ROWS = 10000              # 累積多少筆才一次 executemany + commit
+BULK_LOAD_MIN_ROWS = 1000       # 超過這個筆數改走 LOAD DATA LOCAL INFILE
+
+SESSION = requests.Session()    # 共用 keep-alive 連線，省掉每次 TCP/TLS 握手
+_FINMIND_SEM = threading.BoundedSemaphore(FINMIND_CONCURRENCY)
 
 # ===== 建表（保險）=====
 DDL = f"""
@@ -74,119 +96,271 @@ def _get_db_max_date(stock_id: str) -> Optional[str]:
                 return str(md)
     return None
 
+def _get_all_max_dates() -> Dict[str, str]:
+    """一次 GROUP BY 取回每檔在 DB 的最新日期：{stock_id: 'YYYY-MM-DD'}。"""
+    sql = f"SELECT stock_id, MAX(date) AS max_date FROM {TABLE} GROUP BY stock_id;"
+    out = {}
+    with MySQLConn(DB_NAME) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            for row in cur.fetchall():
+                md = row.get("max_date")
+                if not md:
+                    continue
+                out[str(row["stock_id"])] = md.strftime("%Y-%m-%d") if isinstance(md, (datetime, date)) else str(md)
+    return out
+
+_existing_cols: Optional[set] = None  # SHOW COLUMNS 的快取；只在本程序 ALTER 時更新
+_cols_lock = threading.Lock()
+
 def _ensure_missing_columns(df: pd.DataFrame):
     """若 DF 有表內缺的欄位，自動 ALTER TABLE 補上（以資料型態猜 BIGINT/DOUBLE/VARCHAR）。"""
+    global _existing_cols
     if df.empty:
         return
-    with MySQLConn(DB_NAME) as conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SHOW COLUMNS FROM {TABLE};")
-            existing = {r["Field"] for r in cur.fetchall()}
-            alter_parts = []
-            for col, dtype in df.dtypes.items():
-                if col in ("stock_id", "date"):
-                    continue
-                if col not in existing:
-                    if pd.api.types.is_integer_dtype(dtype):
-                        coltype = "BIGINT"
-                    elif pd.api.types.is_float_dtype(dtype):
-                        coltype = "DOUBLE"
-                    else:
-                        coltype = "VARCHAR(255)"
-                    alter_parts.append(f"ADD COLUMN `{col}` {coltype} NULL")
-            if alter_parts:
+    with _cols_lock:
+        if _existing_cols is None:
+            with MySQLConn(DB_NAME) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"SHOW COLUMNS FROM {TABLE};")
+                    _existing_cols = {r["Field"] for r in cur.fetchall()}
+        alter_parts, added = [], []
+        for col, dtype in df.dtypes.items():
+            if col in ("stock_id", "date") or col in _existing_cols:
+                continue
+            if pd.api.types.is_integer_dtype(dtype):
+                coltype = "BIGINT"
+            elif pd.api.types.is_float_dtype(dtype):
+                coltype = "DOUBLE"
+            else:
+                coltype = "VARCHAR(255)"
+            alter_parts.append(f"ADD COLUMN `{col}` {coltype} NULL")
+            added.append(col)
+        if not alter_parts:
+            return
+        with MySQLConn(DB_NAME) as conn:
+            with conn.cursor() as cur:
                 cur.execute(f"ALTER TABLE {TABLE} " + ", ".join(alter_parts) + ";")
-        conn.commit()
+            conn.commit()
+        _existing_cols.update(added)
 
-def _upsert_df_to_mysql(df: pd.DataFrame) -> int:
-    if df.empty:
-        return 0
+UPSERT_COLS = [
+    "date", "stock_id",
+    "margin_purchase_buy", "margin_purchase_cash_repayment", "margin_purchase_limit",
+    "margin_purchase_sell", "margin_purchase_today_balance", "margin_purchase_yesterday_balance",
+    "note", "offset_loan_and_short",
+    "short_sale_buy", "short_sale_cash_repayment", "short_sale_limit",
+    "short_sale_sell", "short_sale_today_balance", "short_sale_yesterday_balance",
+]
 
-    # 轉 snake_case、丟掉暫存欄位、處理 Null
-    df = finmind_to_snake(df)
-    cols = [
-        "date", "stock_id",
-        "margin_purchase_buy", "margin_purchase_cash_repayment", "margin_purchase_limit",
-        "margin_purchase_sell", "margin_purchase_today_balance", "margin_purchase_yesterday_balance",
-        "note", "offset_loan_and_short",
-        "short_sale_buy", "short_sale_cash_repayment", "short_sale_limit",
-        "short_sale_sell", "short_sale_today_balance", "short_sale_yesterday_balance",
-    ]
-    df = df[cols + [c for c in df.columns if c not in cols]]  # 保留未知欄位讓 _ensure_missing_columns 看得到
-    _ensure_missing_columns(df)  # 先補表欄位
-    data = df[cols].copy()
-    data = df_nulls_to_none(data)
-
-    sql = f"""
-    INSERT INTO {TABLE} (
-        date, stock_id,
-        margin_purchase_buy, margin_purchase_cash_repayment, margin_purchase_limit,
-        margin_purchase_sell, margin_purchase_today_balance, margin_purchase_yesterday_balance,
-        note, offset_loan_and_short,
-        short_sale_buy, short_sale_cash_repayment, short_sale_limit,
-        short_sale_sell, short_sale_today_balance, short_sale_yesterday_balance
-    ) VALUES (
-        %(date)s, %(stock_id)s,
-        %(margin_purchase_buy)s, %(margin_purchase_cash_repayment)s, %(margin_purchase_limit)s,
-        %(margin_purchase_sell)s, %(margin_purchase_today_balance)s, %(margin_purchase_yesterday_balance)s,
-        %(note)s, %(offset_loan_and_short)s,
-        %(short_sale_buy)s, %(short_sale_cash_repayment)s, %(short_sale_limit)s,
-        %(short_sale_sell)s, %(short_sale_today_balance)s, %(short_sale_yesterday_balance)s
-    )
-    ON DUPLICATE KEY UPDATE
-        margin_purchase_buy=VALUES(margin_purchase_buy),
-        margin_purchase_cash_repayment=VALUES(margin_purchase_cash_repayment),
-        margin_purchase_limit=VALUES(margin_purchase_limit),
-        margin_purchase_sell=VALUES(margin_purchase_sell),
-        margin_purchase_today_balance=VALUES(margin_purchase_today_balance),
-        margin_purchase_yesterday_balance=VALUES(margin_purchase_yesterday_balance),
-        note=VALUES(note),
-        offset_loan_and_short=VALUES(offset_loan_and_short),
-        short_sale_buy=VALUES(short_sale_buy),
-        short_sale_cash_repayment=VALUES(short_sale_cash_repayment),
-        short_sale_limit=VALUES(short_sale_limit),
-        short_sale_sell=VALUES(short_sale_sell),
-        short_sale_today_balance=VALUES(short_sale_today_balance),
-        short_sale_yesterday_balance=VALUES(short_sale_yesterday_balance),
-        updated_at=CURRENT_TIMESTAMP;
-    """
-    with MySQLConn(DB_NAME) as conn:
+UPSERT_SQL = f"""
+INSERT INTO {TABLE} (
+    date, stock_id,
+    margin_purchase_buy, margin_purchase_cash_repayment, margin_purchase_limit,
+    margin_purchase_sell, margin_purchase_today_balance, margin_purchase_yesterday_balance,
+    note, offset_loan_and_short,
+    short_sale_buy, short_sale_cash_repayment, short_sale_limit,
+    short_sale_sell, short_sale_today_balance, short_sale_yesterday_balance
+) VALUES (
+    %s, %s,
+    %s, %s, %s,
+    %s, %s, %s,
+    %s, %s,
+    %s, %s, %s,
+    %s, %s, %s
+)
+ON DUPLICATE KEY UPDATE
+    margin_purchase_buy=VALUES(margin_purchase_buy),
+    margin_purchase_cash_repayment=VALUES(margin_purchase_cash_repayment),
+    margin_purchase_limit=VALUES(margin_purchase_limit),
+    margin_purchase_sell=VALUES(margin_purchase_sell),
+    margin_purchase_today_balance=VALUES(margin_purchase_today_balance),
+    margin_purchase_yesterday_balance=VALUES(margin_purchase_yesterday_balance),
+    note=VALUES(note),
+    offset_loan_and_short=VALUES(offset_loan_and_short),
+    short_sale_buy=VALUES(short_sale_buy),
+    short_sale_cash_repayment=VALUES(short_sale_cash_repayment),
+    short_sale_limit=VALUES(short_sale_limit),
+    short_sale_sell=VALUES(short_sale_sell),
+    short_sale_today_balance=VALUES(short_sale_today_balance),
+    short_sale_yesterday_balance=VALUES(short_sale_yesterday_balance),
+    updated_at=CURRENT_TIMESTAMP;
+"""
+
+def _records_to_rows(records: list) -> Tuple[list, Optional[pd.DataFrame]]:
+    """FinMind records 直接轉成 UPSERT_SQL 的 rows；
+    只有出現未知欄位時才另建 snake_case DataFrame，交給 _ensure_missing_columns 補表欄位。"""
+    rows = [row_to_tuple(d) for d in records]
+    drift = None
+    if records and not FINMIND_KNOWN_KEYS.issuperset(records[0]):
+        drift = finmind_to_snake(pd.DataFrame(records))
+    return rows, drift
+
+STAGE_TABLE = f"{TABLE}_stage"
+
+BULK_MERGE_SQL = f"""
+INSERT INTO {TABLE} ({", ".join(UPSERT_COLS)})
+SELECT {", ".join(UPSERT_COLS)} FROM {STAGE_TABLE}
+ON DUPLICATE KEY UPDATE
+    {", ".join(f"{c}=VALUES({c})" for c in UPSERT_COLS if c not in ("date", "stock_id"))},
+    updated_at=CURRENT_TIMESTAMP;
+"""
+
+_bulk_load_disabled = False  # 伺服器不允許 local_infile 時，之後都直接走 executemany
+# 1148 ER_NOT_ALLOWED_COMMAND / 3948 ER_CLIENT_LOCAL_FILES_DISABLED / 2068 CR_LOAD_DATA_LOCAL_INFILE_REJECTED
+LOCAL_INFILE_REFUSED = (1148, 3948, 2068)
+
+class _BulkLoadWarnings(Exception):
+    """LOAD DATA LOCAL 隱含 IGNORE：有壞值只會被轉型成警告，這時改走 executemany 讓錯誤照常丟出。"""
+
+def _load_data_field(v: Any) -> str:
+    """單一值轉成 LOAD DATA 預設跳脫規則下的欄位字串（None → \\N）。"""
+    if v is None:
+        return "\\N"
+    if isinstance(v, (datetime, date)):
+        return v.strftime("%Y-%m-%d")
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    if isinstance(v, (int, float)):
+        return str(v)
+    return '"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _bulk_load(cur, rows: list) -> None:
+    """rows 寫成暫存 CSV → LOAD DATA 進暫存表 → INSERT ... SELECT 合併進正式表。"""
+    # 暫存表同主鍵重複時 LOAD DATA 會留第一筆；先在這裡去重留最後一筆，跟 executemany upsert 一致
+    rows = {(r[0], r[1]): r for r in rows}.values()
+    fd, path = tempfile.mkstemp(prefix="margin_", suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            for r in rows:
+                f.write(",".join(_load_data_field(v) for v in r))
+                f.write("\n")
+        cur.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {STAGE_TABLE} LIKE {TABLE};")
+        cur.execute(f"TRUNCATE TABLE {STAGE_TABLE};")
+        cur.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {STAGE_TABLE} CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+            f"LINES TERMINATED BY '\\n' ({', '.join(UPSERT_COLS)});",
+            (path,),
+        )
+        cur.execute("SELECT @@warning_count AS n;")
+        warnings = cur.fetchone()["n"]
+        if warnings:
+            raise _BulkLoadWarnings(f"{warnings} warnings")
+        cur.execute(BULK_MERGE_SQL)
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def _flush(rows: list) -> int:
+    """一個連線、一個交易把 rows 全部 upsert；筆數多時改走 LOAD DATA。"""
+    global _bulk_load_disabled
+    if not rows:
+        return 0
+    bulk = len(rows) >= BULK_LOAD_MIN_ROWS and not _bulk_load_disabled
+    with MySQLConn(DB_NAME, local_infile=bulk) as conn:
         with conn.cursor() as cur:
-            cur.executemany(sql, data.to_dict(orient="records"))
+            if bulk:
+                try:
+                    _bulk_load(cur, rows)
+                    conn.commit()
+                    return len(rows)
+                except _BulkLoadWarnings as ex:
+                    conn.rollback()
+                    print(f"    ! LOAD DATA 有警告（{ex}），這批改用 executemany")
+                except pymysql.MySQLError as ex:
+                    # 只有伺服器拒絕 local_infile 才永久關掉；deadlock / lock timeout 等照一般寫入失敗往上丟
+                    if not (ex.args and ex.args[0] in LOCAL_INFILE_REFUSED):
+                        raise
+                    conn.rollback()
+                    _bulk_load_disabled = True
+                    print(f"    ! 伺服器不允許 LOAD DATA LOCAL，之後改用 executemany：{ex}")
+            cur.executemany(UPSERT_SQL, rows)
         conn.commit()
-    return len(data)
+    return len(rows)
 
-def run_full_history_for_symbol(stock_id: str, end_date: Optional[str] = None) -> int:
-    """單檔股票：從 DB 最新日+1 續抓，或從 2001-01-01 到今天。"""
-    end = end_date or date.today().isoformat()
-    max_in_db = _get_db_max_date(stock_id)
-    start = (datetime.strptime(max_in_db, "%Y-%m-%d").date() + timedelta(days=1)).isoformat() if max_in_db else START_FALLBACK
-    if start > end:
-        print(f"  - {stock_id} 已最新（DB 最新到 {max_in_db}）")
-        return 0
+def _fetch(stock_id: str, start: str, end: str) -> list:
+    with _FINMIND_SEM:
+        return fetch_margin_short_records(stock_id, start, end, session=SESSION)
 
-    print(f"  ↳ 抓取區間：{start} ~ {end}（分段 {CHUNK_DAYS} 天）")
-    total_written = 0
+def _fetch_windows(stock_id: str, start: str, end: str) -> Iterator[Tuple[str, str, list]]:
+    """先以單次請求抓整段；被 413/429/5xx 拒絕、逾時或連線中斷時退回 CHUNK_DAYS 分段。"""
+    try:
+        records = _fetch(stock_id, start, end)
+    except requests.HTTPError as ex:
+        status = getattr(ex.response, "status_code", None)
+        if status not in FALLBACK_STATUS and not (status and status >= 500):
+            print(f"    ! API 失敗 {stock_id} {start}~{end}: {ex}")
+            return
+        print(f"    ! {stock_id} 單次請求被拒（HTTP {status}），改為分段 {CHUNK_DAYS} 天")
+    except (requests.Timeout, requests.ConnectionError) as ex:
+        print(f"    ! {stock_id} 單次請求逾時/連線中斷（{ex}），改為分段 {CHUNK_DAYS} 天")
+    except Exception as ex:
+        print(f"    ! API 失敗 {stock_id} {start}~{end}: {ex}")
+        return
+    else:
+        yield start, end, records
+        return
 
     for s, e in _daterange_chunks(start, end, CHUNK_DAYS):
+        time.sleep(SLEEP_BETWEEN_CALLS)
         try:
-            df = fetch_margin_short(stock_id, s, e)
+            records = _fetch(stock_id, s, e)
         except Exception as ex:
             print(f"    ! API 失敗 {stock_id} {s}~{e}: {ex}")
-            time.sleep(SLEEP_BETWEEN_CALLS)
             continue
+        yield s, e, records
+
+def _resume_start(stock_id: str, end: str, max_dates: Optional[Dict[str, str]] = None) -> Optional[str]:
+    """回傳續抓起日（DB 最新日+1 或 START_FALLBACK）；已最新則回傳 None。
+    有傳 max_dates（_get_all_max_dates 的結果）就查表，不再逐檔 SELECT MAX。"""
+    max_in_db = max_dates.get(stock_id) if max_dates is not None else _get_db_max_date(stock_id)
+    start = (datetime.strptime(max_in_db, "%Y-%m-%d").date() + timedelta(days=1)).isoformat() if max_in_db else START_FALLBACK
+    if start > end:
+        print(f"  - {stock_id} 已最新（DB 最新到 {max_in_db}）")
+        return None
+    return start
+
+def _fetch_symbol_to_queue(stock_id: str, end: str, max_dates: Dict[str, str], out: queue.Queue) -> None:
+    """worker：把單檔各區間的 (rows, drift) 丟進 out，結束時丟 (stock_id, None, None, None, None)。"""
+    try:
+        start = _resume_start(stock_id, end, max_dates)
+        if start is None:
+            return
+        print(f"  ↳ {stock_id} 抓取區間：{start} ~ {end}")
+        for s, e, records in _fetch_windows(stock_id, start, end):
+            out.put((stock_id, s, e, *_records_to_rows(records)))
+    except Exception as ex:
+        print(f"    ! {stock_id} 抓取失敗：{ex}")
+    finally:
+        out.put((stock_id, None, None, None, None))
+
+def run_full_history_for_symbol(
+    stock_id: str, end_date: Optional[str] = None, max_dates: Optional[Dict[str, str]] = None
+) -> int:
+    """單檔股票：從 DB 最新日+1 續抓，或從 2001-01-01 到今天。"""
+    end = end_date or date.today().isoformat()
+    start = _resume_start(stock_id, end, max_dates)
+    if start is None:
+        return 0
+
+    print(f"  ↳ 抓取區間：{start} ~ {end}")
+    total_written = 0
 
-        if df.empty:
+    for s, e, records in _fetch_windows(stock_id, start, end):
+        if not records:
             print(f"    - 無資料  {s} ~ {e}")
-            time.sleep(SLEEP_BETWEEN_CALLS)
             continue
 
-        written = _upsert_df_to_mysql(df)
+        rows, drift = _records_to_rows(records)
+        if drift is not None:
+            _ensure_missing_columns(drift)
+        written = _flush(rows)
         total_written += written
         print(f"    ✓ 寫入 {written} 筆  {s} ~ {e}")
 
-        time.sleep(SLEEP_BETWEEN_CALLS)
-
     return total_written
 
 def run_full_history(symbols: Optional[Iterable[str]] = None) -> None:
@@ -196,10 +370,59 @@ def run_full_history(symbols: Optional[Iterable[str]] = None) -> None:
     end = date.today().isoformat()
 
     print(f"== TaiwanStockMarginPurchaseShortSale 歷史資料抓取（直到 {end}） ==")
-    for i, sid in enumerate(syms, 1):
-        print(f"[{i}/{len(syms)}] {sid}")
-        total = run_full_history_for_symbol(sid, end_date=end)
-        print(f"  ◎ {sid} 完成：本次寫入 {total} 筆\n")
+    # 多執行緒抓 FinMind，主執行緒當唯一寫入者，避免 MySQL 連線爭用
+    out: queue.Queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    totals = {}
+    done = 0
+    rows_buffer = []
+    seen_cols = set()  # 已檢查過的未知欄位；有新欄位才需要檢查表結構
+
+    def flush_buffer():
+        # 寫入失敗就中止：續抓只看 MAX(date)，丟掉的較早區間之後不會再補
+        try:
+            written = _flush(rows_buffer)
+        except Exception as ex:
+            print(f"    ! 批次寫入失敗（{len(rows_buffer)} 筆），中止：{ex}")
+            raise
+        print(f"    ⇢ 批次寫入 {written} 筆")
+        rows_buffer.clear()
+
+    max_dates = _get_all_max_dates()  # 一次查完所有檔的 DB 最新日
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = [executor.submit(_fetch_symbol_to_queue, sid, end, max_dates, out) for sid in syms]
+        try:
+            while done < len(syms):
+                sid, s, e, rows, drift = out.get()
+                if rows is None:
+                    done += 1
+                    print(f"[{done}/{len(syms)}] ◎ {sid} 完成：本次取得 {totals.pop(sid, 0)} 筆")
+                    continue
+                if not rows:
+                    print(f"    - {sid} 無資料  {s} ~ {e}")
+                    continue
+                if drift is not None and not seen_cols.issuperset(drift.columns):
+                    seen_cols.update(drift.columns)
+                    try:
+                        _ensure_missing_columns(drift)
+                    except Exception as ex:
+                        print(f"    ! {sid} 補表欄位失敗: {ex}")
+                rows_buffer.extend(rows)
+                totals[sid] = totals.get(sid, 0) + len(rows)
+                print(f"    ✓ {sid} 取得 {len(rows)} 筆  {s} ~ {e}")
+                if len(rows_buffer) >= FLUSH_ROWS:
+                    flush_buffer()
+        except BaseException:
+            # 取消還沒開始的 worker，並把佇列清空，讓卡在 out.put 的 worker 能結束，executor 才關得掉
+            for f in futures:
+                f.cancel()
+            while not all(f.done() for f in futures):
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+
+    flush_buffer()
 
 if __name__ == "__main__":
     # 不帶參數就全跑：從 2001-01-01（或 DB 最新日+1）抓到今天，直接插庫
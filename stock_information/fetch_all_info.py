@@ -3,9 +3,10 @@ import sys
 import json
 import re
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Dict, Any
-import random
+from typing import Optional, Dict, Any, List, Tuple
 import requests
 
 # 讓我們能 import 上層的模組
@@ -23,27 +24,46 @@ HEADERS = {
     "Referer": "https://mops.twse.com.tw/mops/web/t05st03",
 }
 
+MAX_WORKERS = 4   # 並行抓取的執行緒數
+MAX_RPS = 2.0     # 對 MOPS 的全域請求速率上限（每秒）
+
+# 共用 keep-alive 連線，省掉每檔重新 TCP/TLS 握手
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
+_rate_lock = threading.Lock()
+_next_slot = 0.0
+
+def _wait_rate_limit() -> None:
+    """簡易 leaky bucket：所有執行緒合計每 1/MAX_RPS 秒放行一個請求"""
+    global _next_slot
+    with _rate_lock:
+        now = time.monotonic()
+        slot = max(now, _next_slot)
+        _next_slot = slot + 1.0 / MAX_RPS
+    time.sleep(slot - now)
+
+_NUM_COMMA_RE = re.compile(r'(?<=\d),(?=\d)')
+
 def remove_number_commas(text: str) -> str:
     """去掉數字中的逗號，但保留其餘內容"""
-    return re.sub(r'(?<=\d),(?=\d)', '', text)
+    return _NUM_COMMA_RE.sub('', text)
+
+def _flatten_value(v: Any) -> Any:
+    if isinstance(v, dict) and "value" in v:
+        val = v["value"]
+        return _NUM_COMMA_RE.sub('', val) if isinstance(val, str) else val
+    return v
 
 def flatten_result(result: Dict[str, Any]) -> Dict[str, Any]:
     """把 MOPS 回傳的 {key: {value, isHidden}} 轉成 {key: value}"""
-    out = {}
-    for k, v in result.items():
-        if isinstance(v, dict) and "value" in v:
-            val = v["value"]
-            if isinstance(val, str):
-                val = remove_number_commas(val)
-            out[k] = val
-        else:
-            out[k] = v
-    return out
+    return {k: _flatten_value(v) for k, v in result.items()}
 
 def fetch_company(company_id: str, timeout: int = 30) -> Optional[Dict[str, Any]]:
     """抓一檔公司資料；若為 ETF 或無公司名則回傳 None"""
     payload = {"companyId": company_id}
-    r = requests.post(MOPS_URL, headers=HEADERS, json=payload, timeout=timeout)
+    _wait_rate_limit()
+    r = SESSION.post(MOPS_URL, json=payload, timeout=timeout)
     r.raise_for_status()
     data = r.json()
 
@@ -59,36 +79,57 @@ def fetch_company(company_id: str, timeout: int = 30) -> Optional[Dict[str, Any]
 
     return flatten_result(result)
 
-def upsert_one(db_name: str, stock_id: str, stock_info: Dict[str, Any]) -> None:
-    """將資料以 JSON 寫入 MySQL；若已存在就更新"""
-    sql = """
-    INSERT INTO tw_stock_company_info (stock_id, stock_info)
-    VALUES (%s, CAST(%s AS JSON))
-    ON DUPLICATE KEY UPDATE
-      stock_info = VALUES(stock_info),
-      updated_at = CURRENT_TIMESTAMP;
-    """
-    payload_json = json.dumps(stock_info, ensure_ascii=False)
+# VALUES 必須是純 %s tuple，pymysql executemany 才會改寫成單一 multi-row INSERT；
+# 寫成 CAST(%s AS JSON) 會讓它退回逐筆 execute。JSON 欄位收字串時 MySQL 會自行轉型。
+UPSERT_SQL = """
+INSERT INTO tw_stock_company_info (stock_id, stock_info)
+VALUES (%s, %s)
+ON DUPLICATE KEY UPDATE
+  stock_info = VALUES(stock_info),
+  updated_at = CURRENT_TIMESTAMP;
+"""
+UPSERT_BATCH_SIZE = 500
+
+def upsert_many(db_name: str, rows: List[Tuple[str, str]]) -> None:
+    """將 (stock_id, stock_info JSON) 一次 executemany 寫入 MySQL；若已存在就更新"""
+    if not rows:
+        return
     with MySQLConn(db=db_name) as conn:
         with conn.cursor() as cur:
-            cur.execute(sql, (stock_id, payload_json))
+            cur.executemany(UPSERT_SQL, rows)
         conn.commit()
 
+def _safe_fetch(code: str) -> Optional[Dict[str, Any]]:
+    try:
+        print(f"抓取 {code} ...")
+        return fetch_company(code)
+    except Exception as e:
+        print(f"失敗 {code}: {e}")
+        return None
+
 def main():
     db_name = "stock_market_data_lake" # 帶入實際資料庫名稱
     codes = list(tickers.keys())  # 取出所有代號
 
-    for code in codes:
+    def flush(rows: List[Tuple[str, str]]) -> None:
         try:
-            print(f"抓取 {code} ...")
-            flat = fetch_company(code)
-            if flat is None:  # ETF 或無資料
-                continue
-            upsert_one(db_name, code, flat)
-            print(f"已寫入 DB：{code}")
+            upsert_many(db_name, rows)
+            print(f"已寫入 DB：{len(rows)} 筆（{rows[0][0]} ~ {rows[-1][0]}）")
         except Exception as e:
-            print(f"失敗 {code}: {e}")
-        time.sleep(random.uniform(1.0, 2.0))  
+            print(f"批次寫入失敗（{len(rows)} 筆）: {e}")
+        rows.clear()
+
+    # 多執行緒抓 MOPS（共用 SESSION + 全域限速），寫 DB 留在主執行緒並累積成批
+    rows: List[Tuple[str, str]] = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        for code, flat in zip(codes, ex.map(_safe_fetch, codes)):
+            if flat is None:  # ETF、無資料或抓取失敗
+                continue
+            rows.append((code, json.dumps(flat, ensure_ascii=False)))
+            if len(rows) >= UPSERT_BATCH_SIZE:
+                flush(rows)
+    if rows:
+        flush(rows)
 
     print("全部完成")
 
@@ -1,6 +1,12 @@
 import os
-import json
-from typing import Any, Dict, Iterable, Tuple, List
+import multiprocessing as mp
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain, islice
+from typing import Any, Dict, Iterable, Sequence, Tuple
+
+import pymysql
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -10,76 +16,71 @@ from stock_information.translate_to_en import (
     build_multilang_name,
     build_multilang_address,
     build_multilang_description,
+    bulk_translate,
+    prime_en_cache,
+    prime_zh_cn,
 )
 
 DB_NAME = "stock_market_data_lake"
 
+# marketName 關鍵字，依序比對、先中先贏（如「上櫃轉上市」算上市）
+MARKET_KEYWORDS = ("上市", "上櫃", "興櫃")
+
 def resolve_market(s: Dict[str, Any]) -> str:
-    m = (s.get("marketName") or "").strip()
-    if m:
-        if "上市" in m:
-            return "上市"
-        if "上櫃" in m:
-            return "上櫃"
+    get = s.get
+    if m := (get("marketName") or "").strip():
+        for kw in MARKET_KEYWORDS:
+            if kw in m:
+                return kw
         return m
-    if s.get("listingDate"):
+    if get("listingDate"):
         return "上市"
-    if s.get("OTCDate"):
+    if get("OTCDate"):
         return "上櫃"
     return "未上市櫃"
 
-def parse_stock_info(val: Any) -> Dict[str, Any]:
-    """stock_info 可能是 str(JSON) 或 dict，統一成 dict。"""
-    if val is None:
-        return {}
-    if isinstance(val, dict):
-        return val
-    try:
-        return json.loads(val)
-    except Exception:
-        return {}
-
 def build_clean_row(stock_id: str, s: Dict[str, Any]) -> Tuple:
-    # 多語系欄位
-    stock_name = build_multilang_name(
-        zh_tw=s.get("companyName"),
-        en_from_field=s.get("companyEnglishName"),
-    )
-
-    address = build_multilang_address(
-        zh_tw=s.get("address"),
-        en_street=s.get("englishAddress_Street"),
-        en_county=s.get("englishAddress_County"),
-    )
+    # 每列只查一次 dict，後面都用 local
+    get = s.get
+    zh_name = get("companyName")
+    en_name = get("companyEnglishName")
+    zh_addr = get("address")
+    en_street = get("englishAddress_Street")
+    en_county = get("englishAddress_County")
+    zh_business = get("mainBusiness")
+    office_site = get("internetAddress") or None
 
-    description = build_multilang_description(
-        zh_tw=s.get("mainBusiness"),
-        en_prefill=None,
-    )
+    # 多語系欄位
+    stock_name = build_multilang_name(zh_tw=zh_name, en_from_field=en_name)
+    address = build_multilang_address(zh_tw=zh_addr, en_street=en_street, en_county=en_county)
+    description = build_multilang_description(zh_tw=zh_business, en_prefill=None)
 
     # industry_id 先設 None，交給後面的 cross-DB SQL 自動補
     industry_id = None
 
     market = resolve_market(s)
-    office_site = s.get("internetAddress") or None
+    # orjson 直接給 UTF-8 bytes；pymysql（binary_prefix 預設關）會原樣送出，不必 decode 再 encode
+    dumps = orjson.dumps
 
     return (
         stock_id,
-        json.dumps(stock_name, ensure_ascii=False),
+        dumps(stock_name),
         industry_id,
         market,
         "TW",
         "TWD",
         office_site,
-        json.dumps(address, ensure_ascii=False),
-        json.dumps(description, ensure_ascii=False),
+        dumps(address),
+        dumps(description),
     )
 
-# 用 COALESCE 避免 None 覆蓋現有值
-UPSERT_SQL = """
+UPSERT_HEAD = """
 INSERT INTO tw_stock_company_info_clean
 (stock_id, stock_name, industry_id, market, country, currency, office_website, address, description)
-VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+VALUES """
+UPSERT_ROW = "(%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+# 用 COALESCE 避免 None 覆蓋現有值
+UPSERT_TAIL = """
 ON DUPLICATE KEY UPDATE
   stock_name = VALUES(stock_name),
   industry_id = COALESCE(VALUES(industry_id), industry_id),
@@ -92,6 +93,35 @@ ON DUPLICATE KEY UPDATE
   updated_at = CURRENT_TIMESTAMP
 """
 
+def build_upsert_sql(n: int) -> str:
+    """n 筆一起寫的 multi-row INSERT ... VALUES (...),(...) ON DUPLICATE KEY UPDATE"""
+    return UPSERT_HEAD + ",".join([UPSERT_ROW] * n) + UPSERT_TAIL
+
+def _estimate_packet_bytes(batch: Sequence[Tuple]) -> int:
+    """粗估整批 multi-row INSERT 的封包大小（值的 UTF-8 長度 + 引號/逗號），不含跳脫字元"""
+    return len(UPSERT_HEAD) + len(UPSERT_TAIL) + sum(
+        (len(v) if isinstance(v, bytes) else len(str(v).encode("utf-8"))) + 4 for row in batch for v in row
+    )
+
+def upsert_batch(cur, batch: Sequence[Tuple], max_bytes: int) -> None:
+    """整批一次 cur.execute。
+    封包過大 server 不會丟 DataError（是 1153 或直接斷線），所以先用 max_bytes 粗估、超過就對半切；
+    DataError（某列值不合法）時也對半切，好的部分照寫，最後把壞列的錯誤丟出。"""
+    if len(batch) > 1 and _estimate_packet_bytes(batch) > max_bytes:
+        mid = len(batch) // 2
+        upsert_batch(cur, batch[:mid], max_bytes)
+        upsert_batch(cur, batch[mid:], max_bytes)
+        return
+    try:
+        cur.execute(build_upsert_sql(len(batch)), list(chain.from_iterable(batch)))
+    except pymysql.err.DataError as e:
+        if len(batch) == 1:
+            raise
+        mid = len(batch) // 2
+        print(f"[WARN] DataError on {len(batch)} rows, splitting into {mid} + {len(batch) - mid}: {e}")
+        upsert_batch(cur, batch[:mid], max_bytes)
+        upsert_batch(cur, batch[mid:], max_bytes)
+
 # 每次啟動最後都要跑的 cross-DB 更新
 UPDATE_FROM_STOCK_DEMO_SQL = """
 UPDATE stock_market_data_lake.tw_stock_company_info_clean AS c
@@ -106,79 +136,128 @@ WHERE c.industry_id IS NULL
    OR c.industry_id <> m.industry_id;
 """
 
-def chunked(iterable: Iterable, size: int) -> Iterable[List]:
-    buf = []
-    for item in iterable:
-        buf.append(item)
-        if len(buf) >= size:
-            yield buf
-            buf = []
-    if buf:
-        yield buf
+try:
+    from itertools import batched  # Python 3.12+，C 實作、每批直接回 tuple
+except ImportError:
+    def batched(iterable: Iterable, n: int) -> Iterable[Tuple]:
+        it = iter(iterable)
+        while batch := tuple(islice(it, n)):
+            yield batch
 
-import pymysql
+# 組 clean row 只用到 stock_info 裡這幾個欄位，讓 MySQL 直接抽出來，不必把整包 JSON 傳回來再 parse
+STOCK_INFO_FIELDS = (
+    "companyName", "companyEnglishName",
+    "address", "englishAddress_Street", "englishAddress_County",
+    "mainBusiness", "internetAddress",
+    "marketName", "listingDate", "OTCDate",
+)
+def _json_text_sql(col: str, key: str) -> str:
+    """JSON 欄位取單一 key 的文字；JSON null 轉成 SQL NULL，跟 parse 後的 None 一致"""
+    return f"JSON_UNQUOTE(NULLIF(JSON_EXTRACT({col}, '$.{key}'), CAST('null' AS JSON)))"
+
+SELECT_SOURCE_SQL = "SELECT stock_id, " + ", ".join(
+    f"{_json_text_sql('stock_info', k)} AS `{k}`" for k in STOCK_INFO_FIELDS
+) + " FROM tw_stock_company_info"
+
+# 上次已翻好的描述；mainBusiness 沒變就直接沿用英文，不再送進模型
+SELECT_PREV_DESCRIPTION_SQL = (
+    f"SELECT stock_id, {_json_text_sql('description', 'zh_tw')} AS zh, "
+    f"{_json_text_sql('description', 'en')} AS en FROM tw_stock_company_info_clean"
+)
 
 READ_BATCH_LIMIT = None
-UPSERT_BATCH_SIZE = 100
+UPSERT_BATCH_SIZE = 500
+OPENCC_WORKERS = os.cpu_count() or 1
+OPENCC_CHUNKSIZE = 64
+COMMIT_EVERY_BATCHES = 10  # 每 N 批 commit 一次，減少 fsync；失敗時最多重跑 N 批
 
 def main():
-    # 1) 讀取來源資料
-    print("[DB] fetch raw rows...")
-    with MySQLConn(db=DB_NAME) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT stock_id, stock_info FROM tw_stock_company_info")
-            rows = cur.fetchall()
+    # 1) 讀取來源資料：欄位在 server 端就從 JSON 抽好，server-side cursor 邊收邊存
+    print("[DB] stream projected rows...")
+    sql = SELECT_SOURCE_SQL
+    params = None
     if READ_BATCH_LIMIT:
-        rows = rows[:READ_BATCH_LIMIT]
-    print(f"[DB] fetched rows: {len(rows)}")
-
-    # 2) 組裝要 upsert 的資料
-    print("[BUILD] building rows ...")
-    to_insert = []
-    for idx, row in enumerate(rows, 1):
-        stock_id = str(row["stock_id"])
-        s = parse_stock_info(row["stock_info"])
-        to_insert.append(build_clean_row(stock_id, s))
-        if idx % 100 == 0:
-            print(f"[BUILD] {idx}/{len(rows)}")
-
-    # 3) upsert
-    print("[DB] upserting...")
-    inserted = 0
+        sql += " LIMIT %s"
+        params = (READ_BATCH_LIMIT,)
+    parsed = []
+    # 讀取、upsert、cross-DB 更新共用同一條連線，省掉重複的 handshake
     with MySQLConn(db=DB_NAME) as conn:
+        with conn.cursor(pymysql.cursors.SSDictCursor) as cur:
+            cur.execute(sql, params)
+            for row in cur:
+                parsed.append((str(row.pop("stock_id")), row))
+        print(f"[DB] fetched rows: {len(parsed)}")
+
+        with conn.cursor(pymysql.cursors.SSDictCursor) as cur:
+            cur.execute(SELECT_PREV_DESCRIPTION_SQL)
+            prev = {str(row["stock_id"]): (row["zh"], row["en"]) for row in cur if row["en"]}
+        reused = {}
+        for stock_id, s in parsed:
+            zh = s.get("mainBusiness")
+            p = prev.get(stock_id)
+            if zh and p and p[0] == zh:
+                reused[zh] = p[1]
+        prime_en_cache(reused)
+        print(f"[TRANSLATE] reuse previous translations: {len(reused)}")
+
+        # 2) 主 process 把所有 mainBusiness 一次批次翻譯（GPU 只有一個使用者）
+        print("[TRANSLATE] batch translating descriptions ...")
+        bulk_translate(s.get("mainBusiness") for _, s in parsed)
+
+        # OpenCC（純 Python）才是 BUILD 的 CPU 大宗：名稱／地址／業務去重後丟給 process pool 各轉一次，
+        # 結果只回存主 process 的快取；用 spawn 避免 fork 到已初始化的 CUDA/tokenizer 執行緒
+        zh_texts = (s.get(k) for _, s in parsed for k in ("companyName", "address", "mainBusiness"))
+        if OPENCC_WORKERS > 1:
+            with ProcessPoolExecutor(max_workers=OPENCC_WORKERS, mp_context=mp.get_context("spawn")) as ex:
+                n = prime_zh_cn(zh_texts, map_fn=partial(ex.map, chunksize=OPENCC_CHUNKSIZE))
+        else:
+            n = prime_zh_cn(zh_texts)
+        print(f"[OPENCC] converted unique inputs: {n}")
+
+        # 組 row 只剩查表 + JSON dumps，直接在主 process 做
+        print("[BUILD] building rows ...")
+        to_insert = []
+        for idx, (stock_id, s) in enumerate(parsed, 1):
+            to_insert.append(build_clean_row(stock_id, s))
+            if idx % 100 == 0:
+                print(f"[BUILD] {idx}/{len(parsed)}")
+
+        # 3) upsert；翻譯可能跑很久，開寫前 ping 一次即可，不必每批都 ping
+        print("[DB] upserting...")
+        conn.ping(reconnect=True)
+        inserted = 0
+        pending = []  # 上次 commit 之後寫入的批次；斷線時交易會被丟掉，要整段重送
         with conn.cursor() as cur:
-            for bi, batch in enumerate(chunked(to_insert, UPSERT_BATCH_SIZE), 1):
+            cur.execute("SELECT @@max_allowed_packet AS n")
+            # 粗估沒算跳脫（JSON 的引號會變兩倍），只用一半當上限
+            max_bytes = cur.fetchone()["n"] // 2
+            for bi, batch in enumerate(batched(to_insert, UPSERT_BATCH_SIZE), 1):
+                pending.append(batch)
                 try:
-                    conn.ping(reconnect=True)
-                except Exception:
-                    pass
-                try:
-                    cur.executemany(UPSERT_SQL, batch)
+                    upsert_batch(cur, batch, max_bytes)
                 except pymysql.err.OperationalError as e:
                     if e.args and e.args[0] in (2006, 2013):
-                        print(f"[WARN] connection lost on batch {bi}, retrying once...")
+                        print(f"[WARN] connection lost on batch {bi}, replaying {len(pending)} uncommitted batches once...")
                         conn.ping(reconnect=True)
-                        cur.executemany(UPSERT_SQL, batch)
+                        for b in pending:
+                            upsert_batch(cur, b, max_bytes)
                     else:
                         raise
-                except pymysql.err.DataError as e:
-                    print(f"[WARN] DataError on batch {bi}, fallback to single insert: {e}")
-                    for rec in batch:
-                        cur.execute(UPSERT_SQL, rec)
-                conn.commit()
                 inserted += len(batch)
-                if bi % 10 == 0:
+                if bi % COMMIT_EVERY_BATCHES == 0:
+                    conn.commit()
+                    pending.clear()
                     print(f"[UPSERT] batch {bi} ({inserted}/{len(to_insert)}) committed")
+        conn.commit()
 
-    print(f"[DB] upsert done. rows: {inserted}")
+        print(f"[DB] upsert done. rows: {inserted}")
 
-    # 4) 每次啟動後立即進行 cross-DB 更新
-    print("[DB] syncing industry_id from financial_statement.stock_demo ...")
-    with MySQLConn(db=DB_NAME) as conn:
+        # 4) 每次啟動後立即進行 cross-DB 更新
+        print("[DB] syncing industry_id from financial_statement.stock_demo ...")
         with conn.cursor() as cur:
             cur.execute(UPDATE_FROM_STOCK_DEMO_SQL)
-            conn.commit()
-    print("[DB] industry_id synced.")
+        conn.commit()
+        print("[DB] industry_id synced.")
 
     print("Done.")
 
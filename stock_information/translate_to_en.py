@@ -1,8 +1,11 @@
 # stock_information/translate_texts.py
-from typing import Optional, Dict, List
-import re, time
+from typing import Callable, Optional, Dict, List, Iterable
+import os, re, time
 from functools import lru_cache
 
+# 關掉 HF tokenizers 內部的執行緒平行化，避免和 OpenCC 的 process pool 搶 CPU（oversubscription）
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
 # 繁轉簡
 try:
     from opencc import OpenCC
@@ -10,14 +13,36 @@ try:
 except Exception:
     _cc_t2s = None
 
+_cc_convert = _cc_t2s.convert if _cc_t2s else (lambda x: x)
+
+# 同集團公司名稱/地址大量重複，以輸入字串快取轉換結果
+_ZH_CN_CACHE: Dict[str, str] = {}
+
+def convert_zh_cn(text: str) -> str:
+    """單筆繁轉簡、不經快取；可直接丟給 process pool 的 map。"""
+    return _cc_convert(text)
+
+def prime_zh_cn(texts: Iterable[Optional[str]], map_fn: Callable = map) -> int:
+    """多筆繁中去重後一次轉好寫入快取；map_fn 傳 executor.map 就能把 OpenCC 分散到多核。回傳新轉換的筆數。"""
+    todo = [t for t in dict.fromkeys(texts) if t and t not in _ZH_CN_CACHE]
+    _ZH_CN_CACHE.update(zip(todo, map_fn(convert_zh_cn, todo)))
+    return len(todo)
+
 def to_zh_cn(text: Optional[str]) -> Optional[str]:
     if not text: return None
-    return _cc_t2s.convert(text) if _cc_t2s else text
+    hit = _ZH_CN_CACHE.get(text)
+    if hit is None:
+        hit = _ZH_CN_CACHE[text] = _cc_convert(text)
+    return hit
 
-MODEL = "HPLT/translate-zh_hant-en-v1.0-hplt_opus"
+MODEL = os.getenv("TRANSLATE_MODEL", "HPLT/translate-zh_hant-en-v1.0-hplt_opus")
 MAX_TOKENS = 800
 MAX_LENGTH = 512
-BATCH_SIZE = 32
+BATCH_SIZE = int(os.getenv("TRANSLATE_BATCH_SIZE", "32"))
+# CUDA 上用 bitsandbytes 8-bit 載入（省一半顯存，可把 TRANSLATE_BATCH_SIZE 拉到 64）；沒裝 bitsandbytes 就退回 fp16/bf16
+LOAD_IN_8BIT = os.getenv("TRANSLATE_LOAD_IN_8BIT", "false").lower() == "true"
+
+_SENT_SPLIT_RE = re.compile(r'(?<=[。．\.!?！？])\s*')
 
 @lru_cache(maxsize=1)
 def _hf_tokenizer():
@@ -30,28 +55,55 @@ def _hf_pipeline():
     print("[translate] loading model (this can take a while on first run) ...")
     import torch
     from transformers import pipeline, AutoModelForSeq2SeqLM
-    device = 0 if torch.backends.mps.is_available() else -1
-    kw = {"torch_dtype": torch.float16} if device == 0 else {}
+    # CUDA 優先（支援就用 bf16），其次 MPS（fp16），都沒有才用 CPU（fp32）
+    if torch.cuda.is_available():
+        device = 0
+        kw = {"torch_dtype": torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16}
+    elif torch.backends.mps.is_available():
+        device = "mps"
+        kw = {"torch_dtype": torch.float16}
+    else:
+        device = -1
+        kw = {}
+        # CPU 推論預設吃滿所有核心，留一半給其他工作，避免 oversubscription
+        torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
     tok = _hf_tokenizer()
-    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL, **kw)
-    return pipeline("translation", model=model, tokenizer=tok, device=device)
+    model = None
+    if LOAD_IN_8BIT and device == 0:
+        try:
+            from transformers import BitsAndBytesConfig
+            model = AutoModelForSeq2SeqLM.from_pretrained(
+                MODEL, quantization_config=BitsAndBytesConfig(load_in_8bit=True), device_map={"": 0}, **kw
+            )
+            device = None  # 8-bit 權重已由 bitsandbytes 放上 GPU，pipeline 不能再搬
+            print("[translate] loaded in 8-bit")
+        except Exception as e:
+            print(f"[translate] 8-bit load failed, fallback to {kw['torch_dtype']}: {e}")
+    if model is None:
+        print(f"[translate] device={device} dtype={kw.get('torch_dtype', torch.float32)}")
+        model = AutoModelForSeq2SeqLM.from_pretrained(MODEL, **kw)
+    model.eval()
+    return pipeline("translation", model=model, tokenizer=tok, device=device, batch_size=BATCH_SIZE)
 
 def _smart_split(text: str) -> List[str]:
     if not text.strip(): return []
     tok = _hf_tokenizer()
-    sents = re.split(r'(?<=[。．\.!?！？])\s*', text)
+    sents = _SENT_SPLIT_RE.split(text)
     sents = [s for s in sents if s.strip()]
-    chunks, cur = [], []
+    if not sents: return []
+    # 一次批次 tokenize 全部句子，不再逐句 tok.encode；之後全程以 ids 操作，最後才 decode
+    enc = tok(sents, add_special_tokens=False)["input_ids"]
+    chunks: List[List[int]] = []
+    cur: List[int] = []
     def flush():
         if cur:
-            chunks.append(tok.decode(cur, skip_special_tokens=True))
+            chunks.append(cur[:])
             cur.clear()
-    for s in sents:
-        ids = tok.encode(s, add_special_tokens=False)
+    for ids in enc:
         if len(ids) > MAX_TOKENS:
             for i in range(0, len(ids), MAX_TOKENS):
                 flush()
-                chunks.append(tok.decode(ids[i:i+MAX_TOKENS], skip_special_tokens=True))
+                chunks.append(ids[i:i+MAX_TOKENS])
             continue
         if len(cur) + len(ids) <= MAX_TOKENS:
             cur.extend(ids)
@@ -59,29 +111,57 @@ def _smart_split(text: str) -> List[str]:
         else:
             flush(); cur.extend(ids)
     flush()
-    compact = []
-    for part in chunks:
-        ids = tok.encode(part, add_special_tokens=False)
-        if compact:
-            prev = compact[-1]
-            pids = tok.encode(prev, add_special_tokens=False)
-            if len(pids)+len(ids) <= MAX_TOKENS:
-                compact[-1] = tok.decode(pids+ids, skip_special_tokens=True)
-                continue
-        compact.append(part)
-    return compact
+    # 合併過短的相鄰 chunk
+    compact: List[List[int]] = []
+    for ids in chunks:
+        if compact and len(compact[-1])+len(ids) <= MAX_TOKENS:
+            compact[-1].extend(ids)
+            continue
+        compact.append(ids)
+    return tok.batch_decode(compact, skip_special_tokens=True)
+
+# 控股公司/ETF 常共用同一段 mainBusiness，相同原文只翻一次；bulk_translate 與 to_en 共用這份快取
+_EN_CACHE: Dict[str, str] = {}
+
+def _translate_parts(parts: List[str]) -> List[str]:
+    """一批切好的片段送進 pipeline（關閉 autograd），回傳對應的英文。"""
+    if not parts: return []
+    import torch
+    pipe = _hf_pipeline()
+    with torch.inference_mode():
+        res = pipe(parts, max_length=MAX_LENGTH, batch_size=BATCH_SIZE)
+    return [r["translation_text"] if isinstance(r, dict) else r for r in res]
+
+def prime_en_cache(translations: Dict[str, str]) -> None:
+    """把別處已翻好的結果（例如上次寫進 clean table 的英文）塞進 _EN_CACHE，之後 to_en 不再碰模型。"""
+    _EN_CACHE.update(translations)
 
 def to_en(text: Optional[str]) -> Optional[str]:
     if not text: return None
-    pipe = _hf_pipeline()
-    parts = _smart_split(text)
-    out = []
-    print(f"[translate] translating: {len(parts)} chunks")
-    for i in range(0, len(parts), BATCH_SIZE):
-        batch = parts[i:i+BATCH_SIZE]
-        res = pipe(batch, max_length=MAX_LENGTH)
-        out.extend([r["translation_text"] if isinstance(r, dict) else r for r in res])
-    return " ".join(out).strip()
+    hit = _EN_CACHE.get(text)
+    if hit is None:
+        parts = _smart_split(text)
+        print(f"[translate] translating: {len(parts)} chunks")
+        hit = _EN_CACHE[text] = " ".join(_translate_parts(parts)).strip()
+    return hit
+
+def bulk_translate(zh_texts: Iterable[Optional[str]]) -> Dict[str, str]:
+    """多筆原文去重、切塊後攤平成一個 list，一次交給 pipeline 批次翻譯；結果寫入 _EN_CACHE。"""
+    texts = [t for t in zh_texts if t]
+    todo = [t for t in dict.fromkeys(texts) if t not in _EN_CACHE]
+    if todo:
+        parts, owner = [], []
+        for i, t in enumerate(todo):
+            ps = _smart_split(t)
+            parts.extend(ps)
+            owner.extend([i] * len(ps))
+        print(f"[translate] bulk translating: {len(todo)} texts / {len(parts)} chunks")
+        outs: List[List[str]] = [[] for _ in todo]
+        for i, en in zip(owner, _translate_parts(parts)):
+            outs[i].append(en)
+        for t, o in zip(todo, outs):
+            _EN_CACHE[t] = " ".join(o).strip()
+    return {t: _EN_CACHE[t] for t in texts}
 
 def build_multilang_name(zh_tw: Optional[str], en_from_field: Optional[str]) -> Dict[str, Optional[str]]:
     return {"zh_tw": zh_tw or None, "zh_cn": to_zh_cn(zh_tw) if zh_tw else None, "en": en_from_field or None}